@@ -1,24 +1,36 @@
 import os
 import tempfile
-import requests
+import shutil
 import replicate
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, Response, StreamingResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from typing import Optional
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 import asyncio
 from asyncio import Queue, Task
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
 import time
 import logging
 import urllib.request
-from urllib.parse import urlparse
-import ffmpeg
+from urllib.parse import urlparse, parse_qsl
 import random
+import re
+import subprocess
+import json
+import hashlib
+import secrets
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+import boto3
+import httpx
+from contextlib import asynccontextmanager
 
 # Load .env from current directory
 load_dotenv()
@@ -27,7 +39,29 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Shared pooled HTTP client (keep-alive + TLS reuse), created in the lifespan handler
+http_client = None
+
+# Chunk size for streaming video downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, VIDEO_ENCODER
+    # Trial encodes take seconds - run them off the loop, once per worker
+    if not os.getenv("VIDEO_ENCODER"):
+        VIDEO_ENCODER = await asyncio.to_thread(detect_video_encoder)
+    logger.info("Using video encoder: %s", VIDEO_ENCODER)
+    http_client = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        follow_redirects=True
+    )
+    await sweep_static_dir()
+    yield
+    await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -42,15 +76,14 @@ class RequestQueueManager:
         self.queue = Queue(maxsize=max_queue_size)
         self.max_concurrent = max_concurrent
         self.active_tasks = set()
-        self.task_semaphore = asyncio.Semaphore(max_concurrent)
         self.stats = {
             "total_processed": 0,
             "total_queued": 0,
             "total_errors": 0,
             "avg_processing_time": 0,
         }
-        # Start the worker
-        asyncio.create_task(self.worker())
+        # Fixed pool of workers - at most max_concurrent jobs run, the rest wait in the queue
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(max_concurrent)]
     
     async def add_task(self, coro, *args, **kwargs):
         # Create a future to track the result
@@ -63,43 +96,50 @@ class RequestQueueManager:
         # Return the future so caller can await it
         return result_future
     
+    def add_task_nowait(self, coro, *args, **kwargs):
+        """Queue a task without waiting for room - raises asyncio.QueueFull when backlogged"""
+        result_future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((coro, args, kwargs, result_future))
+        self.stats["total_queued"] += 1
+        return result_future
+    
     async def worker(self):
         while True:
             # Get a task from the queue
             coro, args, kwargs, result_future = await self.queue.get()
-            
-            # Process the task with semaphore to limit concurrency
-            asyncio.create_task(self._process_task(coro, args, kwargs, result_future))
-    
-    async def _process_task(self, coro, args, kwargs, result_future):
-        async with self.task_semaphore:
-            task_start = time.time()
             try:
-                # Execute the coroutine
-                task = asyncio.create_task(coro(*args, **kwargs))
-                self.active_tasks.add(task)
-                result = await task
-                
-                # Set the result in the future
-                result_future.set_result(result)
-                self.stats["total_processed"] += 1
-                
-                # Update average processing time
-                processing_time = time.time() - task_start
-                self.stats["avg_processing_time"] = (
-                    (self.stats["avg_processing_time"] * (self.stats["total_processed"] - 1) + processing_time) / 
-                    self.stats["total_processed"]
-                )
-                
-            except Exception as e:
-                # Set the exception in the future
-                result_future.set_exception(e)
-                self.stats["total_errors"] += 1
-                logger.error(f"Task error in queue: {e}")
+                await self._process_task(coro, args, kwargs, result_future)
             finally:
-                # Remove the task from active tasks
-                if 'task' in locals():
-                    self.active_tasks.remove(task)
+                self.queue.task_done()
+    
+    async def _process_task(self, coro, args, kwargs, result_future):
+        task_start = time.time()
+        try:
+            # Execute the coroutine
+            task = asyncio.create_task(coro(*args, **kwargs))
+            self.active_tasks.add(task)
+            result = await task
+            
+            # Set the result in the future
+            result_future.set_result(result)
+            self.stats["total_processed"] += 1
+            
+            # Update average processing time
+            processing_time = time.time() - task_start
+            self.stats["avg_processing_time"] = (
+                (self.stats["avg_processing_time"] * (self.stats["total_processed"] - 1) + processing_time) / 
+                self.stats["total_processed"]
+            )
+            
+        except Exception as e:
+            # Set the exception in the future
+            result_future.set_exception(e)
+            self.stats["total_errors"] += 1
+            logger.error("Task error in queue: %s", e)
+        finally:
+            # Remove the task from active tasks
+            if 'task' in locals():
+                self.active_tasks.remove(task)
     
     def get_stats(self):
         return {
@@ -109,34 +149,150 @@ class RequestQueueManager:
         }
 
 # Initialize the queue manager
-request_queue = RequestQueueManager(max_concurrent=5)
+request_queue = RequestQueueManager(max_concurrent=8, max_queue_size=200)
 
 # Decorator for queueing endpoint handlers
 def queued_endpoint(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         # Add the task to the queue and wait for result
-        return await request_queue.add_task(func, *args, **kwargs)
+        result_future = await request_queue.add_task(func, *args, **kwargs)
+        return await result_future
     return wrapper
 
 # Environment variables
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL")  # Optional - enables shared, persistent user state
+VIDEO_BUCKET = os.getenv("VIDEO_BUCKET")  # Optional - deliver videos from S3/R2 instead of /static
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Set for R2/MinIO, leave unset for AWS S3
+TWO_PASS_ENCODE = bool(os.getenv("TWO_PASS_ENCODE"))  # Exact-size two-pass libx264 instead of capped CRF
+REPLICATE_TIMEOUT = float(os.getenv("REPLICATE_TIMEOUT", "300"))  # seconds before a prediction is cancelled
+TWILIO_TIMEOUT = 15  # socket connect/read timeout for Twilio API calls
+WORKER_COUNT = int(os.getenv("WEB_CONCURRENCY", "1"))  # uvicorn --workers, see render.yaml
+
+# Directory that compressed videos are written to and served from at /static
+STATIC_DIR = "/tmp/videos"
+STATIC_FILE_TTL = 3600  # seconds - matches the presigned URL lifetime for S3 uploads
+os.makedirs(STATIC_DIR, exist_ok=True)
 
 if not REPLICATE_API_TOKEN:
     raise ValueError("REPLICATE_API_TOKEN not found in environment variables. Check your .env file.")
 if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
     raise ValueError("Twilio credentials not found in environment variables.")
+if WORKER_COUNT > 1 and not REDIS_URL:
+    raise ValueError("REDIS_URL is required when running more than one worker (WEB_CONCURRENCY > 1).")
 
 os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
 
 # Initialize clients
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=TwilioHttpClient(timeout=TWILIO_TIMEOUT))
+
+# Dedicated thread pool for the blocking Twilio SDK so slow media sends
+# don't stall the event loop or compete with the default executor
+TWILIO_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix='twilio')
+
+# Object storage client - when configured, Twilio fetches media from a presigned
+# URL and video bytes never pass through this process
+s3_client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL) if VIDEO_BUCKET else None
+
+# Write-behind persistence of per-user state to Redis
+class WriteBehindStore:
+    def __init__(self, redis_url, batch_size=100, flush_interval=0.05):
+        self.redis = aioredis.from_url(redis_url)
+        self.queue = Queue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Start the flusher
+        asyncio.create_task(self.worker())
+    
+    def persist(self, key, value, ttl=None):
+        # Never block the caller - the worker writes to Redis in the background
+        self.queue.put_nowait((key, json.dumps(value), ttl))
+    
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Collect up to batch_size writes, or whatever arrives within flush_interval
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for key, value, ttl in batch:
+                        pipe.set(key, value, ex=ttl)
+                    await pipe.execute()
+            except Exception as e:
+                logger.error("State flush failed (%s writes dropped): %s", len(batch), e)
+
+state_store = WriteBehindStore(REDIS_URL) if REDIS_URL else None
+
+class UserStateCache(TTLCache):
+    """Bounded per-process cache of user state; writes persist through state_store.
+    
+    With Redis configured, Redis keeps state for the full ttl and the local copy only
+    lives for local_ttl.
+    """
+    def __init__(self, prefix, maxsize, ttl, local_ttl=60):
+        super().__init__(maxsize=maxsize, ttl=local_ttl if state_store else ttl)
+        self.prefix = prefix
+        self.persist_ttl = ttl
+    
+    def __setitem__(self, phone_number, value):
+        super().__setitem__(phone_number, value)
+        if state_store:
+            state_store.persist(f"{self.prefix}:{phone_number}", value, self.persist_ttl)
+
+class UserPreferences:
+    """Per-user video settings.
+    
+    With Redis configured they live in a hash that every worker reads fresh and updates
+    field by field, so concurrent updates on different workers can't overwrite each other.
+    The local cache only serves display reads (and is the store itself without Redis).
+    """
+    def __init__(self, prefix, maxsize, ttl, local_ttl=60):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=local_ttl if state_store else ttl)
+    
+    async def load(self, phone_number, default, fresh=False):
+        if state_store and (fresh or phone_number not in self.local):
+            try:
+                raw = await state_store.redis.hgetall(f"{self.prefix}:{phone_number}")
+            except Exception as e:
+                logger.error("Preferences load failed for %s: %s", phone_number, e)
+                raw = None
+            if raw:
+                prefs = {**default, **{k.decode(): json.loads(v) for k, v in raw.items()}}
+                self.local[phone_number] = prefs
+                return prefs
+        return self.local.get(phone_number, default)
+    
+    async def update(self, phone_number, updates, default):
+        """Apply only the changed fields and return the resulting settings"""
+        if state_store:
+            key = f"{self.prefix}:{phone_number}"
+            async with state_store.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={k: json.dumps(v) for k, v in updates.items()})
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
+            return await self.load(phone_number, default, fresh=True)
+        prefs = {**self.local.get(phone_number, default), **updates}
+        self.local[phone_number] = prefs
+        return prefs
 
 # Global state management
-conversation_state = {}
-user_preferences = {}
+conversation_state = UserStateCache('state', maxsize=10_000, ttl=24 * 3600)
+user_preferences = UserPreferences('settings', maxsize=10_000, ttl=30 * 24 * 3600)
 
 # Default video settings
 DEFAULT_SETTINGS = {
@@ -154,104 +310,228 @@ class VideoGenerationRequest(BaseModel):
     resolution: Optional[str] = "480p"
     aspect_ratio: Optional[str] = "1:1"
 
+# Basic keyword filtering - one compiled, case-insensitive pass over the prompt
+INAPPROPRIATE_KEYWORDS = ('violence', 'hate', 'explicit', 'harmful')
+INAPPROPRIATE_PATTERN = re.compile(
+    r'\b(' + '|'.join(map(re.escape, INAPPROPRIATE_KEYWORDS)) + r')\b', re.IGNORECASE
+)
+
 # Content moderation function (simplified without OpenAI for now)
-async def moderate_content(text: str):
+def moderate_content(text: str):
     """Simple content moderation - can be enhanced with OpenAI later"""
-    # Basic keyword filtering
-    inappropriate_keywords = ['violence', 'hate', 'explicit', 'harmful']
-    text_lower = text.lower()
-    
-    for keyword in inappropriate_keywords:
-        if keyword in text_lower:
-            return False, f"Content contains inappropriate keyword: {keyword}"
+    match = INAPPROPRIATE_PATTERN.search(text)
+    if match:
+        return False, f"Content contains inappropriate keyword: {match.group(1).lower()}"
     
     return True, "Content is appropriate"
 
+# Accepted setting names (including aliases) and values
+SETTING_KEYS = {
+    'aspect_ratio': 'aspect_ratio',
+    'ratio': 'aspect_ratio',
+    'resolution': 'resolution',
+    'fps': 'fps',
+    'duration': 'duration',
+    'time': 'duration',
+}
+SETTING_CHOICES = {
+    'aspect_ratio': frozenset(('16:9', '9:16', '1:1', '4:3')),
+    'resolution': frozenset(('480p', '720p', '1080p')),
+    'fps': frozenset((24, 30, 60)),
+    'duration': frozenset((3, 5, 10)),
+}
+INT_SETTINGS = frozenset(('fps', 'duration'))
+
+# 'key=value' or 'key value' pairs, each key starting a whitespace-separated token
+SETTING_PAIR_PATTERN = re.compile(r'(?<!\S)(\w+)(?:=|\s+)(\S+)')
+
 # Settings parser function
 def parse_settings_command(message: str):
     """Parse settings commands like '/settings ratio 16:9' or '/settings resolution=480p fps=24'"""
-    parts = message.split()
+    parts = message.split(maxsplit=1)
     if len(parts) < 2:
         return None
     
-    # Remove '/settings' from the beginning
-    settings_parts = parts[1:]
+    # Everything after '/settings'
     updates = {}
+    for key, value in SETTING_PAIR_PATTERN.findall(parts[1]):
+        setting = SETTING_KEYS.get(key.lower())
+        if setting is None:
+            continue
+        
+        if setting in INT_SETTINGS:
+            if not value.isdigit():
+                continue
+            value = int(value)
+        
+        if value in SETTING_CHOICES[setting]:
+            updates[setting] = value
     
-    for part in settings_parts:
-        # Handle key=value format
-        if '=' in part:
-            key, value = part.split('=', 1)
-            key = key.lower().strip()
-            value = value.strip()
-            
-            if key in ['aspect_ratio', 'ratio'] and value in ['16:9', '9:16', '1:1', '4:3']:
-                updates['aspect_ratio'] = value
-            elif key == 'resolution' and value in ['480p', '720p', '1080p']:
-                updates['resolution'] = value
-            elif key == 'fps' and value.isdigit():
-                fps_val = int(value)
-                if fps_val in [24, 30, 60]:
-                    updates['fps'] = fps_val
-            elif key in ['duration', 'time'] and value.isdigit():
-                duration_val = int(value)
-                if duration_val in [3, 5, 10]:
-                    updates['duration'] = duration_val
-        
-        # Handle old format: '/settings ratio 16:9'
-        elif len(settings_parts) >= 2:
-            setting_type = settings_parts[0].lower()
-            setting_value = settings_parts[1]
-            
-            if setting_type in ['ratio', 'aspect_ratio'] and setting_value in ['16:9', '9:16', '1:1', '4:3']:
-                return {'aspect_ratio': setting_value}
-            elif setting_type == 'resolution' and setting_value in ['480p', '720p', '1080p']:
-                return {'resolution': setting_value}
-            elif setting_type == 'fps' and setting_value.isdigit():
-                fps_val = int(setting_value)
-                if fps_val in [24, 30, 60]:
-                    return {'fps': fps_val}
-            elif setting_type in ['duration', 'time'] and setting_value.isdigit():
-                duration_val = int(setting_value)
-                if duration_val in [3, 5, 10]:
-                    return {'duration': duration_val}
+    return updates if updates else None
+
+# Concurrency caps so a burst of users can't starve the CPU or trip Replicate rate limits.
+# The caps are machine-wide - each worker process gets an even share.
+MAX_CONCURRENT_TRANSCODES = int(os.getenv("MAX_CONCURRENT_TRANSCODES", "2"))
+MAX_CONCURRENT_REPLICATE = int(os.getenv("MAX_CONCURRENT_REPLICATE", "8"))
+transcode_semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENT_TRANSCODES // WORKER_COUNT))
+replicate_semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENT_REPLICATE // WORKER_COUNT))
+
+VIDEO_MODEL = "bytedance/seedance-1-pro"
+
+REPLICATE_POLL_INTERVAL = 2  # seconds between prediction status checks
+
+# Outputs of identical (model, input) runs - kept below Replicate's ~1h output URL lifetime
+replicate_output_cache = TTLCache(maxsize=1024, ttl=45 * 60)
+
+# Runs still in progress, by the same key - identical concurrent requests share one prediction
+inflight_generations = {}
+
+def replicate_cache_key(model: str, replicate_input: dict) -> str:
+    payload = json.dumps([model, replicate_input], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _finish_generation(key: str, task: asyncio.Task):
+    inflight_generations.pop(key, None)
+    if not task.cancelled() and task.exception() is None and task.result():
+        replicate_output_cache[key] = task.result()
+
+async def run_replicate(model: str, replicate_input: dict):
+    """Run a Replicate model, reusing the output of an identical recent or in-flight run"""
+    key = replicate_cache_key(model, replicate_input)
+    if key in replicate_output_cache:
+        logger.info("♻️ Reusing cached Replicate output for %s", key[:12])
+        return replicate_output_cache[key]
+    
+    task = inflight_generations.get(key)
+    if task is None:
+        task = asyncio.create_task(_create_and_poll_prediction(model, replicate_input))
+        task.add_done_callback(partial(_finish_generation, key))
+        inflight_generations[key] = task
+    else:
+        logger.info("🔗 Joining in-flight Replicate run for %s", key[:12])
+    # Shielded so one caller giving up doesn't cancel the run for the others
+    return await asyncio.shield(task)
+
+async def _poll_prediction(prediction):
+    while prediction.status not in ("succeeded", "failed", "canceled"):
+        await asyncio.sleep(REPLICATE_POLL_INTERVAL)
+        prediction = await replicate.predictions.async_get(prediction.id)
+    return prediction
+
+async def _create_and_poll_prediction(model: str, replicate_input: dict):
+    """Create a Replicate prediction and poll it on the event loop, bounded by replicate_semaphore"""
+    async with replicate_semaphore:
+        prediction = await replicate.models.predictions.async_create(model=model, input=replicate_input)
+        try:
+            prediction = await asyncio.wait_for(_poll_prediction(prediction), REPLICATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Stop paying for a run nobody will receive
+            try:
+                await replicate.predictions.async_cancel(prediction.id)
+            except Exception as e:
+                logger.warning("Could not cancel prediction %s: %s", prediction.id, e)
+            raise TimeoutError(f"Replicate prediction timed out after {REPLICATE_TIMEOUT:.0f}s") from None
+        if prediction.status != "succeeded":
+            raise replicate.exceptions.ModelError(prediction.error or f"Prediction {prediction.status}")
+        return prediction.output
+
+# Hardware H.264 encoding (VIDEO_ENCODER env overrides detection)
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+def detect_video_encoder():
+    """Pick a hardware H.264 encoder if one actually works on this host, else libx264"""
+    candidates = (
+        ('h264_nvenc', [], []),
+        ('h264_vaapi', ['-vaapi_device', VAAPI_DEVICE], ['-vf', 'format=nv12,hwupload']),
+    )
+    for encoder, input_args, filter_args in candidates:
+        # Builds often list hardware encoders that have no device behind them,
+        # so try a tiny encode rather than trusting `ffmpeg -encoders`
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-loglevel', 'error', *input_args,
+                 '-f', 'lavfi', '-i', 'nullsrc=s=256x256:d=0.1', *filter_args,
+                 '-c:v', encoder, '-f', 'null', '-'],
+                capture_output=True, timeout=15
+            )
+        except (OSError, subprocess.TimeoutExpired):
             break
+        if result.returncode == 0:
+            return encoder
+    return 'libx264'
+
+# Software until the lifespan handler has probed the hardware (unless overridden)
+VIDEO_ENCODER = os.getenv("VIDEO_ENCODER") or 'libx264'
+
+def video_encoder_args(target_bitrate: int):
+    """Input and output argv for VIDEO_ENCODER, capped at target_bitrate"""
+    rate_args = ['-maxrate', f'{target_bitrate}k', '-bufsize', f'{target_bitrate * 2}k']
+    if VIDEO_ENCODER == 'h264_nvenc':
+        return [], [
+            '-vcodec', 'h264_nvenc',
+            '-preset', 'p4',
+            '-rc', 'vbr',
+            '-cq', '26',
+            '-b:v', f'{target_bitrate}k',
+            *rate_args,
+            '-profile:v', 'high',
+            '-pix_fmt', 'yuv420p',
+        ]
+    if VIDEO_ENCODER == 'h264_vaapi':
+        # Frames are filtered on the CPU and uploaded (see compress_video), so no hwaccel decode
+        return ['-vaapi_device', VAAPI_DEVICE], [
+            '-vcodec', 'h264_vaapi',
+            '-qp', '26',
+            *rate_args,
+        ]
+    return [], [
+        '-vcodec', 'libx264',
+        '-preset', 'veryfast',  # Clips are short and already lossy - slower presets buy nothing visible
+        '-crf', '28',  # Offsets the efficiency lost to the fast preset
+        '-profile:v', 'high',  # Better compression efficiency
+        '-level', '4.0',  # Support higher resolutions
+        '-pix_fmt', 'yuv420p',
+        *rate_args,
+        '-tune', 'film,zerolatency',  # Film psy tuning, no lookahead/B-frame delay
+    ]
+
+async def run_ffmpeg(input_path: str, output_path: str, output_args: list, input_args: list = ()):
+    """Run an ffmpeg transcode in a subprocess without blocking the event loop"""
+    async with transcode_semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+            *input_args, '-i', input_path, *output_args, output_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
     
-    return updates if updates else None
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {proc.returncode}: {stderr.decode(errors='replace')[-500:]}")
+
+# Frame heights for the resolution setting
+RESOLUTION_HEIGHTS = {'480p': 480, '720p': 720, '1080p': 1080}
 
-async def compress_video(video_url: str, max_size_mb: int = 15):
+async def compress_video(video_url: str, prefs: dict, max_size_mb: int = 15):
     """Compress video to ensure it's under the specified size limit with high-quality compression (no audio)"""
-    input_path = None
     output_path = None
     
     try:
-        logger.info(f"Starting high-quality video compression for {video_url}")
+        logger.info("Starting high-quality video compression for %s", video_url)
         
-        # Download the original video
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_input:
-            response = requests.get(video_url, stream=True)
-            response.raise_for_status()
-            
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_input.write(chunk)
-            
-            input_path = temp_input.name
-        
-        # Create output file
-        with tempfile.NamedTemporaryFile(suffix='_compressed.mp4', delete=False) as temp_output:
+        # Create output file in the static dir so serving it never crosses filesystems
+        with tempfile.NamedTemporaryFile(suffix='_compressed.mp4', dir=STATIC_DIR, delete=False) as temp_output:
             output_path = temp_output.name
         
-        # Get detailed video info
-        probe = ffmpeg.probe(input_path)
-        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-        
-        duration = float(video_stream['duration'])
-        width = int(video_stream['width'])
-        height = int(video_stream['height'])
-        fps = eval(video_stream['r_frame_rate'])  # Convert fraction to float
+        # The clip was generated with these settings, so no ffprobe pass is needed
+        duration = prefs['duration']
+        fps = prefs['fps']
+        ratio_w, ratio_h = (int(n) for n in prefs['aspect_ratio'].split(':'))
+        short_side = RESOLUTION_HEIGHTS.get(prefs['resolution'], 720)
         
-        # Enhanced bitrate calculation for better quality
-        pixel_count = width * height
+        # Enhanced bitrate calculation for better quality - the resolution names the
+        # short side, so portrait and landscape clips get the same pixel budget
+        pixel_count = short_side * short_side * max(ratio_w, ratio_h) // min(ratio_w, ratio_h)
         complexity_factor = min(1.2, pixel_count / (1920 * 1080))  # Allow higher bitrate for complex videos
         
         # Smart bitrate allocation - reserve less overhead for better quality
@@ -264,112 +544,58 @@ async def compress_video(video_url: str, max_size_mb: int = 15):
         elif fps < 24:
             target_video_bitrate = int(target_video_bitrate * 1.1)   # Boost for low fps
         
-        logger.info(f"Target video bitrate: {target_video_bitrate}k (optimized for quality)")
-        
-        # High-quality compression settings (no audio)
-        ffmpeg_args = {
-            'vcodec': 'libx264',
-            'an': None,  # Remove audio completely
-            'video_bitrate': f'{target_video_bitrate}k',
-            'preset': 'medium',  # Better quality than 'fast'
-            'crf': 23,  # Higher quality (lower CRF)
-            'profile:v': 'high',  # Better compression efficiency
-            'level': '4.0',  # Support higher resolutions
-            'movflags': 'faststart',
-            'pix_fmt': 'yuv420p',
-            'maxrate': f'{int(target_video_bitrate * 1.15)}k',  # Tighter control
-            'bufsize': f'{int(target_video_bitrate * 1.8)}k',
-            'tune': 'film',  # Optimize for film-like content
-            'x264opts': 'ref=3:bframes=3:b-adapt=2:direct=auto:me=umh:subme=8:trellis=1:fast-pskip=0'
-        }
-        
-        # Add smart filtering
-        filters = []
-        if 'field_order' in video_stream and video_stream['field_order'] != 'progressive':
-            filters.append('yadif')  # Deinterlace
-        
-        # Add noise reduction for better compression
-        filters.append('hqdn3d=2:1:2:3')  # Light denoising
-        
-        if filters:
-            ffmpeg_args['vf'] = ','.join(filters)
-        
-        (
-            ffmpeg
-            .input(input_path)
-            .output(output_path, **ffmpeg_args)
-            .overwrite_output()
-            .run(quiet=True)
-        )
+        logger.info("Target video bitrate: %sk (optimized for quality)", target_video_bitrate)
+        
+        input_args, encoder_args = video_encoder_args(target_video_bitrate)
+        
+        # Add noise reduction for better compression (generated clips are progressive, no deinterlace)
+        filters = ['hqdn3d=2:1:2:3']  # Light denoising
+        
+        if VIDEO_ENCODER == 'h264_vaapi':
+            filters.append('format=nv12,hwupload')  # Hand CPU-filtered frames to the GPU
+        
+        filter_args = ['-vf', ','.join(filters)]
+        output_args = [
+            '-an',  # Remove audio completely
+            '-movflags', 'faststart',
+            '-fs', str(int(max_size_mb * 1024 * 1024)),
+            *filter_args
+        ]
+        
+        # ffmpeg reads the URL itself - decoding overlaps the download and the
+        # source never touches disk (HTTP range reads cope with a trailing moov atom)
+        input_args = ['-rw_timeout', '30000000', *input_args]  # Give up on a stalled source after 30s
+        
+        if TWO_PASS_ENCODE and VIDEO_ENCODER == 'libx264':
+            # Two-pass ABR: pass 1 only gathers per-frame stats, pass 2 spends the
+            # bit budget where it's needed and lands within a few % of the target
+            passlog_dir = tempfile.mkdtemp()
+            x264_args = [
+                '-vcodec', 'libx264',
+                '-preset', 'veryfast',
+                '-b:v', f'{target_video_bitrate}k',
+                '-pix_fmt', 'yuv420p',
+                '-passlogfile', os.path.join(passlog_dir, 'ffmpeg2pass')
+            ]
+            try:
+                await run_ffmpeg(video_url, '-', [*x264_args, '-pass', '1', '-an', *filter_args, '-f', 'null'], input_args)
+                await run_ffmpeg(video_url, output_path, [*x264_args, '-pass', '2', *output_args], input_args)
+            finally:
+                shutil.rmtree(passlog_dir, ignore_errors=True)
+        else:
+            # Single-pass capped-quality encode: maxrate/bufsize keep the bitrate
+            # on target and -fs hard-caps the file, so no second encode is ever needed
+            await run_ffmpeg(video_url, output_path, [*encoder_args, *output_args], input_args)
         
         # Check compressed file size
         compressed_size = os.path.getsize(output_path) / (1024 * 1024)  # MB
-        logger.info(f"Video compressed: {compressed_size:.2f}MB (target: {max_size_mb}MB)")
-        
-        # Clean up input file
-        os.unlink(input_path)
-        
-        # If still too large, apply smart secondary compression
-        if compressed_size > max_size_mb:
-            logger.info("Applying smart secondary compression for size optimization")
-            
-            with tempfile.NamedTemporaryFile(suffix='_final.mp4', delete=False) as temp_output2:
-                output_path2 = temp_output2.name
-            
-            # Calculate how much we need to reduce
-            reduction_factor = max_size_mb / compressed_size
-            new_bitrate = int(target_video_bitrate * reduction_factor * 0.9)  # 10% safety margin
-            
-            # Smart scaling - preserve aspect ratio and quality
-            if reduction_factor < 0.7:  # Need significant reduction
-                scale_factor = 0.8  # Moderate scaling
-            elif reduction_factor < 0.5:  # Need major reduction
-                scale_factor = 0.7  # More aggressive scaling
-            else:
-                scale_factor = 0.9  # Minimal scaling
-            
-            scale_filter = f'scale=iw*{scale_factor}:ih*{scale_factor}'
-            
-            # Enhanced secondary compression
-            aggressive_args = {
-                'vcodec': 'libx264',
-                'an': None,
-                'video_bitrate': f'{new_bitrate}k',
-                'preset': 'slow',  # Better compression efficiency
-                'crf': 26,  # Balanced quality
-                'profile:v': 'high',
-                'vf': f'{scale_filter},hqdn3d=3:2:3:3',  # Scaling + stronger denoising
-                'movflags': 'faststart',
-                'pix_fmt': 'yuv420p',
-                'maxrate': f'{int(new_bitrate * 1.1)}k',
-                'bufsize': f'{int(new_bitrate * 1.5)}k',
-                'tune': 'film'
-            }
-            
-            (
-                ffmpeg
-                .input(output_path)
-                .output(output_path2, **aggressive_args)
-                .overwrite_output()
-                .run(quiet=True)
-            )
-            
-            os.unlink(output_path)
-            output_path = output_path2
-            
-            final_size = os.path.getsize(output_path) / (1024 * 1024)
-            logger.info(f"Final optimized size: {final_size:.2f}MB with enhanced quality")
+        logger.info("Video compressed: %.2fMB (target: %sMB)", compressed_size, max_size_mb)
         
         return output_path
         
     except Exception as e:
-        logger.error(f"Video compression failed: {e}")
+        logger.error("Video compression failed: %s", e)
         # Clean up any temp files
-        if input_path and os.path.exists(input_path):
-            try:
-                os.unlink(input_path)
-            except:
-                pass
         if output_path and os.path.exists(output_path):
             try:
                 os.unlink(output_path)
@@ -390,144 +616,111 @@ async def send_whatsapp_message(to: str, message: str, media_url: str = None):
         
         if media_url:
             message_params['media_url'] = [media_url]
-            logger.info(f"📤 Sending with media: {media_url}")
+            logger.info("📤 Sending with media: %s", media_url)
         
-        message = twilio_client.messages.create(**message_params)
-        logger.info(f"✅ Message sent: {message.sid}")
+        # No wait_for here - giving up while the thread is still sending could report a
+        # failure for a message Twilio then delivers. The client's socket timeout bounds stalls.
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(
+            TWILIO_EXECUTOR, partial(twilio_client.messages.create, **message_params)
+        )
+        logger.info("✅ Message sent: %s", message.sid)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Send failed: {str(e)}")
+        logger.error("❌ Send failed: %s", e)
         return False
 
+# Strong references to fire-and-forget sends so they aren't garbage collected mid-flight
+background_tasks = set()
+
+def send_whatsapp_message_nowait(to: str, message: str, media_url: str = None):
+    """Schedule a WhatsApp send without waiting for Twilio - errors are logged by send_whatsapp_message"""
+    task = asyncio.create_task(send_whatsapp_message(to, message, media_url))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def remove_file_quietly(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove %s: %s", path, e)
+
+def remove_file_later(path: str, delay: float = 0):
+    """Delete a file on the default executor after delay seconds, without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    loop.call_later(delay, loop.run_in_executor, None, remove_file_quietly, path)
+
+def _static_file_mtimes():
+    mtimes = []
+    with os.scandir(STATIC_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    mtimes.append((entry.path, entry.stat().st_mtime))
+            except OSError:
+                pass
+    return mtimes
+
+async def sweep_static_dir():
+    """Expire files left in STATIC_DIR by a previous process - its call_later timers died with it"""
+    now = time.time()
+    for path, mtime in await asyncio.to_thread(_static_file_mtimes):
+        remove_file_later(path, max(0, mtime + STATIC_FILE_TTL - now))
+
 async def upload_file_to_temp_server(file_path: str):
-    """Upload compressed video to a temporary file server for Twilio access"""
+    """Upload compressed video to object storage (or the local static route) for Twilio access"""
     try:
-        # Simple file server endpoint on your backend
         filename = os.path.basename(file_path)
-        # Copy file to the /tmp directory that's already mounted as static
-        static_path = os.path.join("/tmp", filename)
-        import shutil
-        shutil.copy2(file_path, static_path)
+        
+        if s3_client:
+            key = f"videos/{filename}"
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, partial(
+                s3_client.upload_file, file_path, VIDEO_BUCKET, key,
+                ExtraArgs={'ContentType': 'video/mp4'}
+            ))
+            public_url = s3_client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': VIDEO_BUCKET, 'Key': key},
+                ExpiresIn=3600
+            )
+            logger.info("📤 File uploaded to bucket %s: %s", VIDEO_BUCKET, key)
+            return public_url
+        
+        # Simple file server endpoint on your backend - compress_video already writes
+        # into the static dir; anything else is moved there (copying across filesystems)
+        static_path = os.path.join(STATIC_DIR, filename)
+        if os.path.abspath(file_path) != static_path:
+            await asyncio.to_thread(shutil.move, file_path, static_path)
+        remove_file_later(static_path, STATIC_FILE_TTL)
         
         # Return the public URL where the file can be accessed
         public_url = f"https://peppo-ai-backend-1.onrender.com/static/{filename}"
-        logger.info(f"📤 File uploaded to: {public_url}")
+        logger.info("📤 File uploaded to: %s", public_url)
         return public_url
         
     except Exception as e:
-        logger.error(f"Failed to upload file: {e}")
+        logger.error("Failed to upload file: %s", e)
         return None
 
-async def generate_video_for_whatsapp(phone_number: str, prompt: str):
-    """Generate video and send to WhatsApp user"""
-    try:
-        logger.info(f"Starting video generation for {phone_number}: {prompt}")
-        
-        # Get user preferences
-        prefs = user_preferences.get(phone_number, DEFAULT_SETTINGS)
-        
-        # Generate video using user preferences (including duration)
-        replicate_input = {
-            "prompt": prompt,
-            "prompt_optimizer": True,
-            "aspect_ratio": prefs['aspect_ratio'],
-            "fps": prefs['fps']
-        }
-        
-        # Add duration if supported by the model
-        if 'duration' in prefs:
-            replicate_input['duration'] = prefs['duration']
-        
-        output = replicate.run(
-            "bytedance/seedance-1-pro",
-            input=replicate_input
-        )
-        
-        if output:
-            # Replicate returns the video URL as a string directly
-            video_url = output
-        else:
-            video_url = None
-        
-        if video_url:
-            logger.info(f"🎬 Generated video URL: {video_url}")
-            
-            # Use the original video URL directly (no compression needed)
-            final_video_url = video_url
-            
-            # Send success message with video AND URL
-            success_msg = (
-                f"🎉 **Your video is ready!**\n\n"
-                f"📝 Prompt: '{prompt}'\n"
-                f"📐 Settings: {prefs['aspect_ratio']}, {prefs['resolution']}, {prefs['fps']}fps, {prefs['duration']}s\n\n"
-                f"📹 **Download Link**: {final_video_url}\n\n"
-                f"Want another video? Use `{VIDEO_TRIGGER} your new prompt` ✨"
-            )
-            
-            # Send video with URL in message body
-            await send_whatsapp_message(phone_number, success_msg, media_url=final_video_url)
-            logger.info(f"✅ Video and URL sent successfully")
-            
-            # Update conversation state
-            conversation_state[phone_number] = {
-                'stage': 'completed',
-                'last_video': final_video_url,
-                'completed_at': asyncio.get_event_loop().time()
-            }
-            
-            logger.info(f"Video generated successfully for {phone_number}")
-            
-        else:
-            raise Exception("No video output received")
-            
-        return {
-            "success": True if video_url else False,
-            "video_url": video_url
-        }
-        
-    except Exception as e:
-        logger.error(f"❌ Video generation failed for {phone_number}: {e}")
-        
-        # Send error message to user
-        error_msg = (
-            f"😔 **Oops! Video generation failed**\n\n"
-            f"📝 Prompt: '{prompt}'\n"
-            f"❌ Error: {str(e)}\n\n"
-            f"Please try again with `{VIDEO_TRIGGER} your prompt` 🔄"
-        )
-        
-        await send_whatsapp_message(phone_number, error_msg)
-        
-        # Update conversation state
-        conversation_state[phone_number] = {
-            'stage': 'error',
-            'error': str(e),
-            'failed_at': asyncio.get_event_loop().time()
-        }
-        
-        return {
-            "success": False,
-            "error": str(e)
-        }
-
 @app.post("/generate")
 @queued_endpoint
 async def generate_video(request: VideoGenerationRequest):
     try:
-        output = replicate.run(
-            "bytedance/seedance-1-pro",
-            input={
-                "prompt": request.prompt,
-                "prompt_optimizer": True
-            }
-        )
+        output = await run_replicate(VIDEO_MODEL, {
+            "prompt": request.prompt,
+            "prompt_optimizer": True
+        })
         return {
             "success": True,
             "video_url": output
         }
     except Exception as e:
-        logger.error(f"Video generation error: {e}")
+        logger.error("Video generation error: %s", e)
         return {
             "success": False,
             "error": str(e)
@@ -543,32 +736,40 @@ async def generate_and_download_video(request: Request):
         if not prompt:
             raise HTTPException(status_code=400, detail="Prompt is required")
         
-        output = replicate.run(
-            "bytedance/seedance-1-pro",
-            input={
-                "prompt": prompt,
-                "prompt_optimizer": True
-            }
-        )
+        output = await run_replicate(VIDEO_MODEL, {
+            "prompt": prompt,
+            "prompt_optimizer": True
+        })
         
         if output and len(output) > 0:
             video_url = output
             
-            with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-                response = requests.get(video_url)
-                temp_file.write(response.content)
-                temp_file_path = temp_file.name
+            # Relay the upstream body straight to the client - no temp file, no full buffer
+            upstream = await http_client.send(http_client.build_request("GET", video_url), stream=True)
+            try:
+                upstream.raise_for_status()
+            except Exception:
+                await upstream.aclose()
+                raise
+            
+            async def relay_body():
+                try:
+                    async for chunk in upstream.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        yield chunk
+                finally:
+                    await upstream.aclose()
             
-            return FileResponse(
-                temp_file_path,
-                media_type="video/mp4",
-                filename=f"generated_video_{hash(prompt)}.mp4"
-            )
+            headers = {'Content-Disposition': f'attachment; filename="generated_video_{secrets.token_hex(8)}.mp4"'}
+            # Length is only valid if httpx isn't decoding a compressed body
+            if 'content-length' in upstream.headers and 'content-encoding' not in upstream.headers:
+                headers['Content-Length'] = upstream.headers['content-length']
+            
+            return StreamingResponse(relay_body(), media_type="video/mp4", headers=headers)
         else:
             raise HTTPException(status_code=500, detail="Failed to generate video")
             
     except Exception as e:
-        logger.error(f"Generate and download error: {e}")
+        logger.error("Generate and download error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/")
@@ -584,9 +785,9 @@ async def get_queue_stats():
 async def test_video_url(url: str):
     """Test endpoint to validate video URLs"""
     try:
-        response = requests.head(url, timeout=10, allow_redirects=True)
+        response = await http_client.head(url, timeout=10)
         
-        return {
+        return ORJSONResponse({
             "url": url,
             "status_code": response.status_code,
             "content_type": response.headers.get('content-type'),
@@ -595,76 +796,160 @@ async def test_video_url(url: str):
             "headers": dict(response.headers),
             "accessible": response.status_code == 200,
             "is_video": response.headers.get('content-type', '').startswith('video/')
-        }
+        })
     except Exception as e:
-        return {
+        return ORJSONResponse({
             "url": url,
             "error": str(e),
             "accessible": False
-        }
+        })
 
 # Add trigger configuration
 VIDEO_TRIGGER = "!generate"  # Users type "!generate your prompt here"
 
+# Status message parts, keyed by delivery outcome
+STATUS_HEADERS = {
+    'ok': "🎉 **Your video is ready!**",
+    'fallback': "🎉 **Video Generated Successfully!**",
+    'error': "❌ **Video Processing Failed**",
+}
+STATUS_FOOTERS = {
+    'ok': f"Want another video? Use `{VIDEO_TRIGGER} your new prompt` ✨",
+    'fallback': (
+        "⚠️ Video couldn't be delivered directly. Click the URL above to download.\n\n"
+        f"Want another video? Use `{VIDEO_TRIGGER} your new prompt` ✨"
+    ),
+    'error': "The video was generated but couldn't be processed. Please try again.",
+}
+
+# Fixed bot replies - built once at import rather than on every message
+HELP_MSG = (
+    "🤖 **Video Generator Bot Help**\n\n"
+    f"🎬 **Generate Video**: `{VIDEO_TRIGGER} your prompt here`\n"
+    "⚙️ **Settings**: `/settings` or `/settings aspect_ratio=1:1`\n"
+    "❓ **Help**: `/help`\n\n"
+    "**Available Settings:**\n"
+    "• `aspect_ratio`: 16:9, 1:1, 9:16\n"
+    "• `resolution`: 720p, 1080p, 480p\n"
+    "• `fps`: 24, 30, 60\n"
+    "• `duration`: 3, 5, 10 (seconds)\n\n"
+    f"**Example**: `{VIDEO_TRIGGER} a cat playing with a ball`"
+)
+WELCOME_MSG = (
+    f"👋 Hi! I'm your video generator bot.\n\n"
+    f"🎬 To generate a video, use: `{VIDEO_TRIGGER} your prompt`\n"
+    f"⚙️ To change settings, use: `/settings`\n"
+    f"❓ For help, use: `/help`\n\n"
+    f"**Example**: `{VIDEO_TRIGGER} a dog running in a park`"
+)
+MISSING_PROMPT_MSG = (
+    f"❌ Please provide a prompt after {VIDEO_TRIGGER}\n\n"
+    f"Example: `{VIDEO_TRIGGER} a sunset over the ocean`"
+)
+MODERATION_REJECTED_MSG = (
+    "❌ **Content Moderation Alert**\n\n"
+    "Your prompt contains inappropriate content. Please try a different prompt."
+)
+GENERIC_ERROR_MSG = "❌ Sorry, something went wrong. Please try again or use `/help` for assistance."
+INVALID_SETTINGS_MSG = "❌ Invalid settings format. Use `/settings` to see current settings."
+SETTINGS_FAILED_MSG = "❌ Settings update failed. Please try again."
+
+# Templates for messages with per-request fields - filled with str.format / format_map
+ACK_TEMPLATE = (
+    "🎬 **Generating your video...**\n\n"
+    "📝 Prompt: '{prompt}'\n"
+    "⏱️ This usually takes 30-60 seconds\n\n"
+    "Please wait... ⏳"
+)
+QUEUE_STATUS_TEMPLATE = (
+    "🎭 **Your video is in the queue!**\n\n"
+    "🧙‍♂️ Our AI wizards are hard at work creating your masterpiece...\n"
+    "🎬 Prompt: '{prompt}'\n\n"
+    "🔄 Position in queue: {position}\n"
+    "⏳ Estimated time remaining: {eta} seconds\n\n"
+    "Did you know? Each video is uniquely crafted just for you! 🌟"
+)
+GENERATION_FAILED_TEMPLATE = (
+    "❌ **Video Generation Failed**\n\n"
+    "📝 Prompt: '{prompt}'\n"
+    "🔧 Error: {error}\n\n"
+    "Please try again with a different prompt or use `/help` for assistance."
+)
+_SETTINGS_LINES = (
+    "📐 Aspect Ratio: `{aspect_ratio}`\n"
+    "📺 Resolution: `{resolution}`\n"
+    "🎞️ FPS: `{fps}`\n"
+    "⏱️ Duration: `{duration}s`\n\n"
+)
+CURRENT_SETTINGS_TEMPLATE = (
+    "⚙️ **Current Settings**\n\n" + _SETTINGS_LINES +
+    "**To change settings:**\n"
+    "`/settings aspect_ratio=1:1`\n"
+    "`/settings resolution=1080p fps=60`\n"
+    "`/settings duration=10`"
+)
+SETTINGS_UPDATED_TEMPLATE = (
+    "✅ **Settings Updated**\n\n" + _SETTINGS_LINES +
+    f"Ready for video generation! Use `{VIDEO_TRIGGER} your prompt`"
+)
+
+def render_status(kind: str, prompt: str, prefs: dict, url: str = None, error: str = None):
+    """Render a video status message - only the URL and error lines vary"""
+    details = (
+        f"📝 Prompt: '{prompt}'\n"
+        f"📐 Settings: {prefs['aspect_ratio']}, {prefs['resolution']}, {prefs['fps']}fps, {prefs['duration']}s"
+    )
+    if error:
+        details += f"\n🔧 Error: {error}"
+    
+    parts = [STATUS_HEADERS[kind], details]
+    if url:
+        parts.append(f"📹 **Video URL**: {url}")
+    parts.append(STATUS_FOOTERS[kind])
+    return "\n\n".join(parts)
+
+async def handle_help_command(phone_number: str, message_body: str):
+    await send_whatsapp_message(phone_number, HELP_MSG)
+    return True
+
+async def handle_generate_command(phone_number: str, message_body: str):
+    prompt = message_body[len(VIDEO_TRIGGER):].strip()
+    if not prompt:
+        await send_whatsapp_message(phone_number, MISSING_PROMPT_MSG)
+        return True
+    return await handle_video_generation(phone_number, prompt)
+
 async def handle_incoming_message(phone_number: str, message_body: str):
     """Handle all incoming WhatsApp messages with proper routing"""
     try:
-        logger.info(f"📱 Incoming message from {phone_number}: {message_body}")
-        
-        # Handle settings commands
-        if message_body.startswith('/settings'):
-            return await handle_settings_command(phone_number, message_body)
-        
-        # Handle help command
-        elif message_body.startswith('/help'):
-            help_msg = (
-                "🤖 **Video Generator Bot Help**\n\n"
-                f"🎬 **Generate Video**: `{VIDEO_TRIGGER} your prompt here`\n"
-                "⚙️ **Settings**: `/settings` or `/settings aspect_ratio=1:1`\n"
-                "❓ **Help**: `/help`\n\n"
-                "**Available Settings:**\n"
-                "• `aspect_ratio`: 16:9, 1:1, 9:16\n"
-                "• `resolution`: 720p, 1080p, 480p\n"
-                "• `fps`: 24, 30, 60\n"
-                "• `duration`: 3, 5, 10 (seconds)\n\n"
-                f"**Example**: `{VIDEO_TRIGGER} a cat playing with a ball`"
-            )
-            await send_whatsapp_message(phone_number, help_msg)
-            return True
+        logger.info("📱 Incoming message from %s: %s", phone_number, message_body)
         
-        # Handle video generation trigger
-        elif message_body.startswith(VIDEO_TRIGGER):
-            prompt = message_body[len(VIDEO_TRIGGER):].strip()
-            if not prompt:
-                await send_whatsapp_message(phone_number, 
-                    f"❌ Please provide a prompt after {VIDEO_TRIGGER}\n\n"
-                    f"Example: `{VIDEO_TRIGGER} a sunset over the ocean`")
-                return True
-            
-            return await handle_video_generation(phone_number, prompt)
+        # Route on the first word; anything that isn't a command gets the welcome message
+        command = message_body.split(maxsplit=1)[0] if message_body else ''
+        handler = COMMANDS.get(command)
+        if handler:
+            return await handler(phone_number, message_body)
         
-        # Handle regular messages (no trigger)
-        else:
-            welcome_msg = (
-                f"👋 Hi! I'm your video generator bot.\n\n"
-                f"🎬 To generate a video, use: `{VIDEO_TRIGGER} your prompt`\n"
-                f"⚙️ To change settings, use: `/settings`\n"
-                f"❓ For help, use: `/help`\n\n"
-                f"**Example**: `{VIDEO_TRIGGER} a dog running in a park`"
-            )
-            await send_whatsapp_message(phone_number, welcome_msg)
-            return True
+        await send_whatsapp_message(phone_number, WELCOME_MSG)
+        return True
             
     except Exception as e:
-        logger.error(f"❌ Error handling message from {phone_number}: {e}")
-        await send_whatsapp_message(phone_number, 
-            "❌ Sorry, something went wrong. Please try again or use `/help` for assistance.")
+        logger.error("❌ Error handling message from %s: %s", phone_number, e)
+        send_whatsapp_message_nowait(phone_number, GENERIC_ERROR_MSG)
         return False
 
 async def handle_video_generation(phone_number: str, prompt: str):
     """Handle video generation requests with proper error handling"""
     try:
-        logger.info(f"🎬 Starting video generation for {phone_number}: {prompt}")
+        logger.info("🎬 Starting video generation for %s: %s", phone_number, prompt)
+        
+        # Content moderation first - rejected prompts cost no ack round-trip
+        is_appropriate, reason = moderate_content(prompt)
+        if not is_appropriate:
+            logger.info("🚫 Prompt rejected for %s: %s", phone_number, reason)
+            await send_whatsapp_message(phone_number, MODERATION_REJECTED_MSG)
+            conversation_state[phone_number] = {'stage': 'rejected'}
+            return False
         
         # Update conversation state
         conversation_state[phone_number] = {
@@ -673,38 +958,9 @@ async def handle_video_generation(phone_number: str, prompt: str):
             'started_at': asyncio.get_event_loop().time()
         }
         
-        # Send acknowledgment
-        ack_msg = (
-            f"🎬 **Generating your video...**\n\n"
-            f"📝 Prompt: '{prompt}'\n"
-            f"⏱️ This usually takes 30-60 seconds\n\n"
-            f"Please wait... ⏳"
-        )
-        await send_whatsapp_message(phone_number, ack_msg)
-        
-        # Content moderation
-        if not await moderate_content(prompt):
-            await send_whatsapp_message(phone_number, 
-                "❌ **Content Moderation Alert**\n\n"
-                "Your prompt contains inappropriate content. Please try a different prompt.")
-            conversation_state[phone_number] = {'stage': 'rejected'}
-            return False
-        
         # Get user preferences
-        prefs = user_preferences.get(phone_number, DEFAULT_SETTINGS)
-        logger.info(f"📐 Using settings: {prefs}")
-        
-        # Send a funny waiting message after a short delay
-        await asyncio.sleep(5)  # Wait 5 seconds before sending the funny message
-        funny_msg = (
-            f"🎭 **Your video is in the queue!**\n\n"
-            f"🧙‍♂️ Our AI wizards are hard at work creating your masterpiece...\n"
-            f"🎬 Prompt: '{prompt}'\n\n"
-            f"🔄 Position in queue: {request_queue.queue.qsize() + 1}\n"
-            f"⏳ Estimated time remaining: {random.randint(10, 30)} seconds\n\n"
-            f"Did you know? Each video is uniquely crafted just for you! 🌟"
-        )
-        await send_whatsapp_message(phone_number, funny_msg)
+        prefs = await user_preferences.load(phone_number, DEFAULT_SETTINGS, fresh=True)
+        logger.info("📐 Using settings: %s", prefs)
         
         # Generate video using Replicate - bytedance/seedance-1-pro supports all parameters
         replicate_input = {
@@ -716,12 +972,32 @@ async def handle_video_generation(phone_number: str, prompt: str):
             "camera_fixed": False
         }
         
-        logger.info(f"🔄 Calling Replicate with: {replicate_input}")
-        output = replicate.run("bytedance/seedance-1-pro", input=replicate_input)
+        # Repeat request - the video is ready, so skip the ack and send it in one message
+        cached_url = replicate_output_cache.get(replicate_cache_key(VIDEO_MODEL, replicate_input))
+        if cached_url:
+            logger.info("♻️ Cached video for %s, skipping acknowledgment", phone_number)
+            return await handle_generated_video(phone_number, prompt, cached_url, prefs)
+        
+        # Acknowledge while Replicate starts - neither depends on the other
+        logger.info("🔄 Calling Replicate with: %s", replicate_input)
+        generation = asyncio.create_task(run_replicate(VIDEO_MODEL, replicate_input))
+        await send_whatsapp_message(phone_number, ACK_TEMPLATE.format(prompt=prompt))
+        
+        # Send a funny waiting message after a short delay, unless the video is already back
+        await asyncio.wait({generation}, timeout=5)
+        if not generation.done():
+            funny_msg = QUEUE_STATUS_TEMPLATE.format(
+                prompt=prompt,
+                position=request_queue.queue.qsize() + 1,
+                eta=random.randint(10, 30)
+            )
+            await send_whatsapp_message(phone_number, funny_msg)
+        
+        output = await generation
         
         if output and len(output) > 0:
             video_url = output
-            logger.info(f"✅ Video generated: {video_url}")
+            logger.info("✅ Video generated: %s", video_url)
             
             # Handle the generated video
             return await handle_generated_video(phone_number, prompt, video_url, prefs)
@@ -729,14 +1005,9 @@ async def handle_video_generation(phone_number: str, prompt: str):
             raise Exception("No video output received from Replicate")
             
     except Exception as e:
-        logger.error(f"❌ Video generation failed for {phone_number}: {e}")
+        logger.error("❌ Video generation failed for %s: %s", phone_number, e)
         
-        error_msg = (
-            f"❌ **Video Generation Failed**\n\n"
-            f"📝 Prompt: '{prompt}'\n"
-            f"🔧 Error: {str(e)}\n\n"
-            f"Please try again with a different prompt or use `/help` for assistance."
-        )
+        error_msg = GENERATION_FAILED_TEMPLATE.format(prompt=prompt, error=e)
         await send_whatsapp_message(phone_number, error_msg)
         
         conversation_state[phone_number] = {
@@ -748,22 +1019,10 @@ async def handle_video_generation(phone_number: str, prompt: str):
 async def handle_generated_video(phone_number: str, prompt: str, video_url: str, prefs: dict):
     """Handle the video received from Replicate - compress and send"""
     try:
-        logger.info(f"📹 Processing generated video: {video_url}")
-        
-        # Optional validation (non-blocking)
-        try:
-            response = requests.head(video_url, timeout=5)
-            if response.status_code == 200:
-                content_type = response.headers.get('content-type', '')
-                content_length = response.headers.get('content-length', 'unknown')
-                logger.info(f"✅ Video accessible: {content_type}, {content_length} bytes")
-            else:
-                logger.warning(f"⚠️ Video URL returned {response.status_code}")
-        except Exception as e:
-            logger.warning(f"⚠️ Could not validate video URL: {e}")
+        logger.info("📹 Processing generated video: %s", video_url)
         
         # Compress video if needed
-        compressed_video_path = await compress_video(video_url, max_size_mb=15)
+        compressed_video_path = await compress_video(video_url, prefs, max_size_mb=15)
         
         # Determine final video URL
         final_video_url = video_url  # Default to original
@@ -773,49 +1032,36 @@ async def handle_generated_video(phone_number: str, prompt: str, video_url: str,
             uploaded_url = await upload_file_to_temp_server(compressed_video_path)
             if uploaded_url:
                 final_video_url = uploaded_url
-                logger.info(f"📤 Using uploaded compressed video: {uploaded_url}")
+                logger.info("📤 Using uploaded compressed video: %s", uploaded_url)
             else:
-                logger.warning(f"⚠️ Upload failed, using original URL")
+                logger.warning("⚠️ Upload failed, using original URL")
             
-            # Clean up local file
-            try:
-                if os.path.exists(compressed_video_path):
-                    os.unlink(compressed_video_path)
-            except:
-                pass
+            # Clean up the local file unless it's being served from the static dir
+            # (upload_file_to_temp_server schedules its expiry)
+            if s3_client or not uploaded_url:
+                remove_file_later(compressed_video_path)
         
-        logger.info(f"🎯 Final video URL for delivery: {final_video_url}")
+        logger.info("🎯 Final video URL for delivery: %s", final_video_url)
         
-        # Send success message with video
-        success_msg = (
-            f"🎉 **Your video is ready!**\n\n"
-            f"📝 Prompt: '{prompt}'\n"
-            f"📐 Settings: {prefs['aspect_ratio']}, {prefs['resolution']}, {prefs['fps']}fps, {prefs['duration']}s\n\n"
-            f"Want another video? Use `{VIDEO_TRIGGER} your new prompt` ✨"
-        )
+        # Send success message with video - the URL is in the body too, so the
+        # text alone is enough if the handset can't render the attachment
+        success_msg = render_status('ok', prompt, prefs, url=final_video_url)
         
         # Try to send video as media attachment
-        logger.info(f"🚀 Attempting to send video as media attachment...")
+        logger.info("🚀 Attempting to send video as media attachment...")
         video_sent = await send_whatsapp_message(phone_number, success_msg, media_url=final_video_url)
         
         if not video_sent:
-            # Fallback: send URL if video delivery fails
-            logger.info(f"📋 Media delivery failed, sending fallback URL message...")
-            fallback_msg = (
-                f"🎉 **Video Generated Successfully!**\n\n"
-                f"📝 Prompt: '{prompt}'\n"
-                f"📐 Settings: {prefs['aspect_ratio']}, {prefs['resolution']}, {prefs['fps']}fps, {prefs['duration']}s\n\n"
-                f"📹 **Video URL**: {final_video_url}\n\n"
-                f"⚠️ Video couldn't be delivered directly. Click the URL above to download.\n\n"
-                f"Want another video? Use `{VIDEO_TRIGGER} your new prompt` ✨"
-            )
+            # Fallback: only needed when Twilio rejected the media send itself
+            logger.info("📋 Media send failed, sending fallback URL message...")
+            fallback_msg = render_status('fallback', prompt, prefs, url=final_video_url)
             fallback_sent = await send_whatsapp_message(phone_number, fallback_msg)
             if fallback_sent:
-                logger.info(f"✅ Fallback URL message sent successfully")
+                logger.info("✅ Fallback URL message sent successfully")
             else:
-                logger.error(f"❌ Both media and fallback message failed!")
+                logger.error("❌ Both media and fallback message failed!")
         else:
-            logger.info(f"✅ Video delivered successfully as media attachment")
+            logger.info("✅ Video delivered successfully as media attachment")
         
         # Update conversation state
         conversation_state[phone_number] = {
@@ -824,18 +1070,13 @@ async def handle_generated_video(phone_number: str, prompt: str, video_url: str,
             'completed_at': asyncio.get_event_loop().time()
         }
         
-        logger.info(f"✅ Video successfully delivered to {phone_number}")
+        logger.info("✅ Video successfully delivered to %s", phone_number)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Failed to handle generated video: {e}")
+        logger.error("❌ Failed to handle generated video: %s", e)
         
-        error_msg = (
-            f"❌ **Video Processing Failed**\n\n"
-            f"📝 Prompt: '{prompt}'\n"
-            f"🔧 Error: {str(e)}\n\n"
-            f"The video was generated but couldn't be processed. Please try again."
-        )
+        error_msg = render_status('error', prompt, prefs, error=str(e))
         await send_whatsapp_message(phone_number, error_msg)
         return False
 
@@ -844,84 +1085,114 @@ async def handle_settings_command(phone_number: str, message_body: str):
     try:
         if message_body.strip() == '/settings':
             # Show current settings
-            prefs = user_preferences.get(phone_number, DEFAULT_SETTINGS)
-            settings_msg = (
-                f"⚙️ **Current Settings**\n\n"
-                f"📐 Aspect Ratio: `{prefs['aspect_ratio']}`\n"
-                f"📺 Resolution: `{prefs['resolution']}`\n"
-                f"🎞️ FPS: `{prefs['fps']}`\n"
-                f"⏱️ Duration: `{prefs['duration']}s`\n\n"
-                f"**To change settings:**\n"
-                f"`/settings aspect_ratio=1:1`\n"
-                f"`/settings resolution=1080p fps=60`\n"
-                f"`/settings duration=10`"
-            )
-            await send_whatsapp_message(phone_number, settings_msg)
+            prefs = await user_preferences.load(phone_number, DEFAULT_SETTINGS)
+            send_whatsapp_message_nowait(phone_number, CURRENT_SETTINGS_TEMPLATE.format_map(prefs))
             return True
         else:
             # Parse and update settings
             updates = parse_settings_command(message_body)
             if updates:
-                if phone_number not in user_preferences:
-                    user_preferences[phone_number] = DEFAULT_SETTINGS.copy()
-                
-                user_preferences[phone_number].update(updates)
-                prefs = user_preferences[phone_number]
+                prefs = await user_preferences.update(phone_number, updates, DEFAULT_SETTINGS)
                 
-                success_msg = (
-                    f"✅ **Settings Updated**\n\n"
-                    f"📐 Aspect Ratio: `{prefs['aspect_ratio']}`\n"
-                    f"📺 Resolution: `{prefs['resolution']}`\n"
-                    f"🎞️ FPS: `{prefs['fps']}`\n"
-                    f"⏱️ Duration: `{prefs['duration']}s`\n\n"
-                    f"Ready for video generation! Use `{VIDEO_TRIGGER} your prompt`"
-                )
-                await send_whatsapp_message(phone_number, success_msg)
+                send_whatsapp_message_nowait(phone_number, SETTINGS_UPDATED_TEMPLATE.format_map(prefs))
                 return True
             else:
-                await send_whatsapp_message(phone_number, 
-                    "❌ Invalid settings format. Use `/settings` to see current settings.")
+                send_whatsapp_message_nowait(phone_number, INVALID_SETTINGS_MSG)
                 return False
                 
     except Exception as e:
-        logger.error(f"❌ Settings command failed: {e}")
-        await send_whatsapp_message(phone_number, 
-            "❌ Settings update failed. Please try again.")
+        logger.error("❌ Settings command failed: %s", e)
+        send_whatsapp_message_nowait(phone_number, SETTINGS_FAILED_MSG)
         return False
 
-@app.post("/webhook")
-async def whatsapp_webhook(request: Request):
-    """Enhanced Twilio webhook for WhatsApp messages - returns proper TwiML"""
+# Command word -> handler(phone_number, message_body)
+COMMANDS = {
+    '/settings': handle_settings_command,
+    '/help': handle_help_command,
+    VIDEO_TRIGGER: handle_generate_command,
+}
+
+# Empty TwiML never changes - serialize it once instead of per webhook.
+# Response objects aren't mutated when sent, so one instance can be reused.
+EMPTY_TWIML = str(MessagingResponse()).encode('utf-8')
+EMPTY_TWIML_RESPONSE = Response(content=EMPTY_TWIML, media_type="application/xml")
+QUEUE_FULL_MSG = "⏳ We're handling a lot of requests right now - please try again in a minute!"
+
+# MessageSids seen recently - Twilio redelivers on slow/failed webhooks.
+# With Redis the record is shared, so a redelivery to another worker is caught too.
+MESSAGE_SID_TTL = 600
+seen_message_sids = TTLCache(maxsize=100_000, ttl=MESSAGE_SID_TTL)
+
+async def is_duplicate_message(message_sid: str) -> bool:
+    """Record message_sid and report whether it had already been seen"""
+    if state_store:
+        try:
+            first_seen = await state_store.redis.set(f"msgsid:{message_sid}", 1, nx=True, ex=MESSAGE_SID_TTL)
+            return not first_seen
+        except Exception as e:
+            logger.error("MessageSid check failed for %s, using local record: %s", message_sid, e)
+    if message_sid in seen_message_sids:
+        return True
+    seen_message_sids[message_sid] = True
+    return False
+
+async def process_webhook(body: bytes = None, fields: dict = None):
+    """Parse, dedupe and queue a webhook message - runs after the TwiML has been sent"""
     try:
-        form_data = await request.form()
+        # Twilio posts small urlencoded bodies - parse them directly rather
+        # than going through the generic form/multipart parser
+        if fields is None:
+            fields = dict(parse_qsl(body.decode('utf-8'), max_num_fields=64))
         
         # Extract message details
-        from_number = form_data.get('From', '').replace('whatsapp:', '')
-        message_body = form_data.get('Body', '').strip()
-        
-        logger.info(f"📨 Webhook received from {from_number}: {message_body}")
+        from_number = fields.get('From', '').replace('whatsapp:', '')
+        message_body = fields.get('Body', '').strip()
         
-        # Create TwiML response
-        resp = MessagingResponse()
+        logger.info("📨 Webhook received from %s: %s", from_number, message_body)
         
         if not from_number or not message_body:
             logger.warning("❌ Invalid webhook data received")
-            # Return empty TwiML response
-            return Response(content=str(resp), media_type="application/xml")
+            return
         
-        # Queue the message handling instead of creating a task directly
-        await request_queue.add_task(handle_incoming_message, from_number, message_body)
+        # Drop retried deliveries so the same message never generates twice
+        message_sid = fields.get('MessageSid')
+        if message_sid and await is_duplicate_message(message_sid):
+            logger.info("🔁 Duplicate webhook for %s, ignoring", message_sid)
+            return
         
-        # Return empty TwiML response immediately (Twilio requirement)
-        return Response(content=str(resp), media_type="application/xml")
+        # Queue the message handling - when the backlog is full, shed load instead of piling up
+        try:
+            request_queue.add_task_nowait(handle_incoming_message, from_number, message_body)
+        except asyncio.QueueFull:
+            logger.warning("🚦 Queue full, telling %s to retry later", from_number)
+            send_whatsapp_message_nowait(from_number, QUEUE_FULL_MSG)
+    
+    except Exception as e:
+        logger.error("❌ Webhook processing error: %s", e)
+
+@app.post("/webhook")
+async def whatsapp_webhook(request: Request):
+    """Twilio webhook for WhatsApp messages - answers with empty TwiML, then processes the message"""
+    try:
+        if request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            task = BackgroundTask(process_webhook, body=await request.body())
+        else:
+            task = BackgroundTask(process_webhook, fields=dict(await request.form()))
+        
+        # Return the TwiML immediately (Twilio requirement) - parsing happens after it's flushed
+        return Response(content=EMPTY_TWIML, media_type="application/xml", background=task)
             
     except Exception as e:
-        logger.error(f"❌ Webhook error: {e}")
+        logger.error("❌ Webhook error: %s", e)
         # Always return valid TwiML even on error
-        resp = MessagingResponse()
-        return Response(content=str(resp), media_type="application/xml")
-
-from fastapi.staticfiles import StaticFiles
+        return EMPTY_TWIML_RESPONSE
 
-# Add this after your app initialization
-app.mount("/static", StaticFiles(directory="/tmp"), name="static")
\ No newline at end of file
+@app.api_route("/static/{filename}", methods=["GET", "HEAD"])
+async def serve_static_file(filename: str, request: Request):
+    """Serve uploaded videos so Twilio can fetch them as media"""
+    # Only serve files directly inside STATIC_DIR
+    path = os.path.join(STATIC_DIR, os.path.basename(filename))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    return FileResponse(path, media_type="video/mp4", method=request.method)
\ No newline at end of file